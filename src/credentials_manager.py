@@ -1,11 +1,14 @@
 import base64
+import binascii
+import functools
 import hashlib
+import hmac
 import json
 import platform
 import secrets
 import struct
 from pathlib import Path
-from typing import Optional
+from typing import NoReturn, Optional
 
 __all__ = ('CredentialsManager', 'CredentialsNotFoundError')
 
@@ -19,6 +22,7 @@ class CredentialsNotFoundError(Exception):
         super().__init__(self.message)
 
 
+@functools.lru_cache(maxsize=1)
 def _get_key_length() -> tuple[int, int]:
     """Determine the key and salt lengths based on system information.
 
@@ -26,6 +30,9 @@ def _get_key_length() -> tuple[int, int]:
     softwarecharacteristics, then uses this hash to derive lengths for the
     encryption key and salt.
 
+    The system information does not change during the lifetime of a process,
+    so the result is computed once and cached.
+
     Returns:
         tuple[int, int]: A tuple containing the key length and salt length.
     """
@@ -41,14 +48,13 @@ def _get_key_length() -> tuple[int, int]:
 
     # Hash the string
     hash_object = hashlib.sha256(info_string.encode())
-    hash_hex = hash_object.hexdigest()
+    digest = hash_object.digest()
 
     # Use the first 2 bytes of the hash to determine key length
     # This will give a number between 0 and 65535
-    RADIX = 0x10
-    key_length = int(hash_hex[:4], RADIX)
+    key_length = int.from_bytes(digest[:2], 'big')
     # Use the next 2 bytes of the hash to determine salt length
-    salt_length = int(hash_hex[4:8], RADIX)
+    salt_length = int.from_bytes(digest[2:4], 'big')
 
     # Ensure the key length is within a reasonable range (e.g., 16 to 64 bytes)
     MIN_LENGTH, MAX_LENGTH = 0x10, 0x40
@@ -59,6 +65,71 @@ def _get_key_length() -> tuple[int, int]:
     return clip(key_length), clip(salt_length)
 
 
+def _digest_password(password: str) -> bytes:
+    """Hash a password into the digest used to verify it and derive keys.
+
+    hashlib.sha256 is backed by OpenSSL, which uses the SHA extensions of
+    the CPU where they are available.
+
+    Args:
+        password (str): The password to hash.
+
+    Returns:
+        bytes: The SHA-256 hex digest of the password, as ASCII bytes.
+    """
+    return hashlib.sha256(password.encode()).hexdigest().encode('ascii')
+
+
+def _xor_bytes(a: bytes | memoryview, b: bytes | memoryview) -> bytes:
+    """XOR two byte strings of equal length.
+
+    Both operands are converted to big integers and XOR'd as a whole, which
+    keeps the per-byte work in C instead of a Python level loop.
+
+    Args:
+        a (bytes | memoryview): The first operand.
+        b (bytes | memoryview): The second operand, must be the same length
+                                as `a`.
+
+    Returns:
+        bytes: The bytewise XOR of `a` and `b`.
+    """
+    n = len(a)
+    if n == 0:
+        return b''
+
+    x = int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+    return x.to_bytes(n, 'big')
+
+
+def _raise_invalid_input(**fields: object) -> NoReturn:
+    """Raise the appropriate error for the first invalid credential field.
+
+    Validation in the hot paths is a single combined check, this function is
+    only called once that check fails, to work out which error to raise.
+
+    Args:
+        **fields (object): The credential fields to check, keyed by the name
+                           used in the error message, in order of precedence.
+
+    Raises:
+        TypeError: If a field is not a string.
+        ValueError: If a field is an empty string.
+    """
+    for field, value in fields.items():
+        if not isinstance(value, str):
+            raise TypeError(
+                f'Credential {field} must be of type {str},'
+                f' found type {type(value)}'
+            )
+
+        if len(value) <= 0:
+            raise ValueError(f"Credential {field} must be a non-empty string")
+
+    # Only reached if called with valid fields, which callers never do
+    raise ValueError("Invalid credential input")
+
+
 class CredentialsManager:
     """A class for securely managing and storing credentials.
 
@@ -66,34 +137,79 @@ class CredentialsManager:
     using a password-based encryption scheme.
     """
 
+    __slots__ = (
+        '__mapping',
+        '__pswd_digest',
+        '__salt',
+        '__key_bytes',
+        '__key_tile',
+        '__mac',
+        '__weakref__',
+    )
+
     __KEY_RANGE, __SALT_RANGE = tuple(map(range, _get_key_length()))
 
+    # Size of the precomputed keystream, most credentials fit well within it
+    __KEYSTREAM_TILE = 0x1000
+
+    # scrypt cost parameters used to derive the encryption key
+    # (CPU/memory cost, block size, parallelization), this uses 16 MiB
+    __SCRYPT_N, __SCRYPT_R, __SCRYPT_P = 2**14, 8, 1
+
+    # Every ciphertext is followed by its HMAC-SHA256 tag
+    __TAG_LENGTH = hashlib.sha256().digest_size
+
+    # Length of the HMAC key, derived alongside the encryption key
+    __MAC_KEY_LENGTH = hashlib.sha256().digest_size
+
+    # Known message whose tag is saved to verify the password on load
+    __PASSWORD_CHECK = b'__cm_password__'
+
+    # Version of the credentials file format written by `save`. Files from
+    # releases up to 0.1.1 have no version field and cannot be loaded
+    __FILE_VERSION = 2
+
+    # First byte of every HMAC message, keeps credential tags and the
+    # password verifier from ever being valid in place of one another
+    __CREDENTIAL_CONTEXT, __VERIFIER_CONTEXT = b'\x00', b'\x01'
+
     def __init__(
         self,
         password: str,
         *,
-        salt: Optional[bytearray] = None,
+        salt: Optional[bytes] = None,
         pswd_is_digest: bool = False,
     ):
         """Initialize the CredentialsManager.
 
         Args:
             password (str): The password used for encryption.
-            salt (bytearray): A salt for the encryption key.
-                              If not provided, a salt is generated.
+            salt (bytes): A salt for the encryption key.
+                          If not provided, a salt is generated.
             pswd_is_digest (bool): If True, the password is already
                                    a SHA-256 digest.
         """
-        self.__mapping: dict[str, bytearray] = {}
-        self._update_encryptions(
-            password=password, salt=salt, pswd_is_digest=pswd_is_digest
-        )
+        # Only user credentials live in the mapping, the metadata needed to
+        # verify the password and derive the key is kept separately
+        self.__mapping: dict[str, bytes] = {}
+        self.__pswd_digest: bytes
+        self.__salt: bytes
+        self.__key_bytes: bytes
+        self.__key_tile: bytes
+        self.__mac: hmac.HMAC
+
+        if pswd_is_digest:
+            pswd = password.encode('ascii')
+        else:
+            # Intentionally lose the reference to the password
+            pswd = _digest_password(password)
+
+        self._update_encryptions(pswd=pswd, salt=salt)
 
     def _update_encryptions(
         self,
-        password: str,
-        salt: Optional[bytearray] = None,
-        pswd_is_digest: bool = False,
+        pswd: bytes,
+        salt: Optional[bytes] = None,
     ) -> None:
         """Update the encryption key and re-encrypt stored credentials.
 
@@ -102,10 +218,10 @@ class CredentialsManager:
         new key.
 
         Args:
-            password (str): The new password for encryption.
-            salt (Optional[bytearray]): A new salt for the encryption key.
-                                        If not provided, the existing salt is used.
-            pswd_is_digest (bool): If True, the password is already a SHA-256 digest.
+            pswd (bytes): The SHA-256 hex digest of the new password,
+                          encoded as ASCII bytes.
+            salt (Optional[bytes]): A new salt for the encryption key.
+                                    If not provided, a salt is generated.
 
         Note:
             This method should be called whenever the password or salt is changed
@@ -114,43 +230,143 @@ class CredentialsManager:
             Ideally, this method should not be called directly,
             rather it should be invoked by either
             the __init__ or `update_password` methods
-        """
-        if not pswd_is_digest:
-            # Intentionally lose the reference to the password
-            password = hashlib.sha256(password.encode()).hexdigest()
 
-        pswd = bytearray(map(ord, password))
+        Raises:
+            ValueError: If a stored credential fails the integrity check,
+                        nothing is changed in that case.
+        """
+        # Check every stored credential under the current key first. The
+        # re-keyed credentials are signed again, which would otherwise turn
+        # tampered or truncated credentials into valid ones
+        for name, blob in self.__mapping.items():
+            view = memoryview(blob)
+            if len(view) < self.__TAG_LENGTH or not hmac.compare_digest(
+                self._tag(name, view[: -self.__TAG_LENGTH]),
+                view[-self.__TAG_LENGTH :],
+            ):
+                raise ValueError(f'"{name}" failed the integrity check')
 
         # Make a salt, if not provided
-        salt = salt or bytearray(
-            [secrets.randbelow(0x100) for _ in self.__SALT_RANGE]
+        salt = salt or secrets.token_bytes(len(self.__SALT_RANGE))
+
+        # Derive the encryption and HMAC keys from the password digest and
+        # the salt. They must be independent, anyone who knows a plain text
+        # can recover the encryption key, which must not let them forge tags
+        derived = hashlib.scrypt(
+            pswd,
+            salt=salt,
+            n=self.__SCRYPT_N,
+            r=self.__SCRYPT_R,
+            p=self.__SCRYPT_P,
+            dklen=len(self.__KEY_RANGE) + self.__MAC_KEY_LENGTH,
         )
+        k = len(self.__KEY_RANGE)
+        key, mac_key = derived[:k], derived[k:]
+
+        # HMAC with the key absorbed once, copied for every tag computed
+        self.__mac = hmac.new(mac_key, digestmod='sha256')
 
-        # Make a key using the password digest and the salt
-        f = lambda i: pswd[i % len(pswd)] ^ salt[i % len(salt)]
-        key = bytearray(map(f, self.__KEY_RANGE))
+        tile = key * (self.__KEYSTREAM_TILE // len(key) + 1)
 
         # Update existing encryptions
+        if self.__mapping:
+            # XOR is its own inverse and both keys have the same length, so
+            # re-keying is a single XOR with the difference of the two
+            # keystreams, no need to decrypt to plain text and encrypt again.
+            # The difference is computed once, and shared by all credentials
+            delta = _xor_bytes(self.__key_tile, tile)
+            for name, blob in self.__mapping.items():
+                cipher = memoryview(blob)[: -self.__TAG_LENGTH]
+                n = len(cipher)
+                if n <= len(delta):
+                    keystream = delta[:n]
+                else:
+                    # The difference repeats with the same period as the key
+                    period = delta[: len(key)]
+                    keystream = (period * -(-n // len(key)))[:n]
+
+                rekeyed = _xor_bytes(cipher, keystream)
+                self.__mapping[name] = rekeyed + self._tag(name, rekeyed)
+
+        self.__key_bytes = key
+        self.__key_tile = tile
 
-        # Decrypt with the current key
-        original: dict[str, str] = {
-            k: self.get(k)
-            for k in self.__mapping.keys()
-            if k not in ('__cm_password__', '__salt__')
-        }
+        # Update metadata
+        self.__pswd_digest = pswd
+        self.__salt = salt
 
-        # Now encrypt with the new key
-        self.__key = key
-        for name, data in original.items():
-            self.store(name, data, overwrite=True)
+    def _tag(self, name: str, cipher: bytes | memoryview) -> bytes:
+        """Compute the HMAC-SHA256 tag of a credential.
 
-        # Update metadata
-        self.__mapping.update(
-            {
-                '__cm_password__': pswd,
-                '__salt__': salt,
-            }
-        )
+        The tag covers a context byte, the length prefixed name and the
+        ciphertext, so a ciphertext is only accepted under the name it was
+        stored with, and never in place of the password verifier.
+
+        The padded key blocks of the HMAC are hashed once per key, each tag
+        starts from a copy of that state, so only the message is hashed.
+
+        Args:
+            name (str): The name of the credential.
+            cipher (bytes | memoryview): The ciphertext to authenticate.
+
+        Returns:
+            bytes: The HMAC-SHA256 tag of the credential.
+        """
+        encoded = name.encode('utf-8')
+
+        mac = self.__mac.copy()
+        mac.update(self.__CREDENTIAL_CONTEXT)
+        mac.update(len(encoded).to_bytes(4, 'big'))
+        mac.update(encoded)
+        mac.update(cipher)
+        return mac.digest()
+
+    def _encrypt(self, name: str, data: str) -> bytes:
+        """Encrypt and authenticate credential data.
+
+        Args:
+            name (str): The name the credential is stored under.
+            data (str): The credential data to encrypt.
+
+        Returns:
+            bytes: The ciphertext followed by its HMAC-SHA256 tag.
+        """
+        plain = data.encode('utf-8')
+        cipher = _xor_bytes(plain, self._keystream(len(plain)))
+
+        # Authenticate the ciphertext, so tampering is detected on retrieval
+        return cipher + self._tag(name, cipher)
+
+    def _password_verifier(self) -> bytes:
+        """Compute the verifier saved alongside the credentials.
+
+        The verifier is the HMAC of a known message under the current key, it
+        can only be reproduced by deriving the same key, so it reveals nothing
+        about the password that the salt and a full key derivation do not.
+        Its own context byte keeps it from passing as a credential tag.
+
+        Returns:
+            bytes: The password verifier for the current key.
+        """
+        mac = self.__mac.copy()
+        mac.update(self.__VERIFIER_CONTEXT)
+        mac.update(self.__PASSWORD_CHECK)
+        return mac.digest()
+
+    def _keystream(self, n: int) -> bytes:
+        """Get the first `n` bytes of the repeated encryption key.
+
+        Args:
+            n (int): The number of keystream bytes required.
+
+        Returns:
+            bytes: The key repeated and truncated to exactly `n` bytes.
+        """
+        if n <= len(self.__key_tile):
+            return self.__key_tile[:n]
+
+        # Larger than the precomputed tile, build it for this call only
+        return (self.__key_bytes * -(-n // len(self.__key_bytes)))[:n]
 
     def update_password(self, old_password: str, new_password: str) -> None:
         """Update the password used for encryption.
@@ -164,19 +380,20 @@ class CredentialsManager:
             new_password (str): The new password to set.
 
         Raises:
-            ValueError: If the old password is incorrect.
+            ValueError: If the old password is incorrect, or a stored
+                        credential fails the integrity check.
         """
         # Intentionally lose the references to the passwords
-        old_password = hashlib.sha256(old_password.encode()).hexdigest()
+        old_pswd = _digest_password(old_password)
+        new_pswd = _digest_password(new_password)
 
-        old_pswd = bytearray(map(ord, old_password))
-
-        if old_pswd != self.__mapping['__cm_password__']:
+        # Constant time comparison, to not leak timing information
+        if not hmac.compare_digest(old_pswd, self.__pswd_digest):
             raise ValueError(
                 'Cannot update password, old password is incorrect'
             )
 
-        self._update_encryptions(password=new_password)
+        self._update_encryptions(pswd=new_pswd)
 
     def store(self, name: str, data: str, overwrite: bool = False) -> None:
         """Store a credential.
@@ -190,33 +407,60 @@ class CredentialsManager:
             ValueError: If the credential already exists and overwrite is False.
         """
         # Input validation starts
-        if not isinstance(name, str):
-            raise TypeError(
-                f'Credential name must be of type {str},'
-                f' found type {type(name)}'
+        if not (
+            isinstance(name, str) and name and isinstance(data, str) and data
+        ):
+            _raise_invalid_input(name=name, data=data)
+
+        # Only look the name up when overwriting is not allowed
+        if not overwrite and name in self.__mapping:
+            raise ValueError(
+                'Cannot overwrite credential unless `overwrite=True` is passed'
             )
 
-        if len(name) <= 0:
-            raise ValueError("Credential name must be a non-empty string")
+        # Input validation ends, real work begins
 
-        if not isinstance(data, str):
-            raise TypeError(
-                f'Credential data must be of type {str},'
-                f' found type {type(data)}'
-            )
+        self.__mapping[name] = self._encrypt(name, data)
+
+    def store_many(
+        self, credentials: dict[str, str], overwrite: bool = False
+    ) -> None:
+        """Store multiple credentials at once.
 
-        if len(data) <= 0:
-            raise ValueError("Credential data must be a non-empty string")
+        All credentials are validated before any of them is stored, so either
+        every credential is stored or none are.
 
-        if name in self.__mapping and not overwrite:
+        Args:
+            credentials (dict[str, str]): A mapping of credential names to the
+                                          credential data to store.
+            overwrite (bool): If True, allow overwriting existing credentials.
+
+        Raises:
+            ValueError: If any credential already exists and overwrite is False.
+        """
+        # Input validation starts
+        for name, data in credentials.items():
+            if not (
+                isinstance(name, str)
+                and name
+                and isinstance(data, str)
+                and data
+            ):
+                _raise_invalid_input(name=name, data=data)
+
+        if not overwrite and not self.__mapping.keys().isdisjoint(credentials):
             raise ValueError(
                 'Cannot overwrite credential unless `overwrite=True` is passed'
             )
 
         # Input validation ends, real work begins
 
-        f = lambda x: ord(x[1]) ^ self.__key[x[0] % len(self.__key)]
-        self.__mapping[name] = bytearray(map(f, enumerate(data)))
+        self.__mapping.update(
+            {
+                name: self._encrypt(name, data)
+                for name, data in credentials.items()
+            }
+        )
 
     def get(self, name: str) -> str:
         """Retrieve a stored credential.
@@ -228,25 +472,29 @@ class CredentialsManager:
             str: The decrypted credential data.
 
         Raises:
-            ValueError: If the credential name is not found.
+            ValueError: If the credential name is not found, or the stored
+                        credential fails the integrity check.
         """
         # Input validation starts
-        if not isinstance(name, str):
-            raise TypeError(
-                f'Credential name must be of type {str},'
-                f' found type {type(name)}'
-            )
-
-        if len(name) <= 0:
-            raise ValueError("Credential name must be a non-empty string")
+        if not (isinstance(name, str) and name):
+            _raise_invalid_input(name=name)
 
-        if name not in self.__mapping:
+        # A single lookup, stored values are never None
+        stored = self.__mapping.get(name)
+        if stored is None:
             raise ValueError(f'"{name}" is not a known credential')
 
         # Input validation ends, real work begins
 
-        f = lambda x: x[1] ^ self.__key[x[0] % len(self.__key)]
-        plain = bytearray(map(f, enumerate(self.__mapping[name])))
+        # Zero-copy views, the ciphertext and tag are only read from
+        blob = memoryview(stored)
+        cipher = blob[: -self.__TAG_LENGTH]
+        tag = blob[-self.__TAG_LENGTH :]
+
+        if not hmac.compare_digest(self._tag(name, cipher), tag):
+            raise ValueError(f'"{name}" failed the integrity check')
+
+        plain = _xor_bytes(cipher, self._keystream(len(cipher)))
         return plain.decode('utf-8')
 
     def save(self, filename: str | Path) -> None:
@@ -262,15 +510,27 @@ class CredentialsManager:
 
         filename = str(filename)
 
-        # We encode the bytearray to base64 to have JSON Serializable data
+        # We encode the bytes to base64 to have JSON Serializable data
         # I do not believe this would make the credentials less secure
-        data = {
-            k: base64.b64encode(v).decode('utf-8')
-            for k, v in self.__mapping.items()
-        }
 
-        with open(filename, 'w') as f:
-            json.dump(data, f)
+        # The JSON object is written one entry at a time, so no intermediate
+        # dictionary of base64 strings is built. Names are escaped by json,
+        # base64 output is plain ASCII and never needs escaping
+        with open(filename, 'wb') as f:
+            f.write(b'{"version": %d, ' % self.__FILE_VERSION)
+            f.write(b'"__cm_password__": "')
+            f.write(base64.b64encode(self._password_verifier()))
+            f.write(b'", "__salt__": "')
+            f.write(base64.b64encode(self.__salt))
+            f.write(b'", "credentials": {')
+            for i, (k, v) in enumerate(self.__mapping.items()):
+                if i:
+                    f.write(b', ')
+                f.write(json.dumps(k).encode('ascii'))
+                f.write(b': "')
+                f.write(base64.b64encode(v))
+                f.write(b'"')
+            f.write(b'}}')
 
     @classmethod
     def load(cls, filename: str | Path, password: str) -> 'CredentialsManager':
@@ -286,8 +546,8 @@ class CredentialsManager:
         Raises:
             CredentialsNotFoundError: If the credentials file is not found.
             TypeError: If the file content is not a valid dictionary.
-            ValueError: If the file is missing required fields or the password
-                        is incorrect.
+            ValueError: If the file is a legacy or unsupported version, is
+                        missing required fields, or the password is incorrect.
         """
         if not filename or not isinstance(filename, (str, Path)):
             raise ValueError(
@@ -296,11 +556,6 @@ class CredentialsManager:
 
         filename = str(filename)
 
-        # Intentionally lose our reference to the password
-        # We only care about the hash
-        password = hashlib.sha256(password.encode()).hexdigest()
-        given_pswd = bytearray(map(ord, password))
-
         # Open, read and load the file
         try:
             with open(filename) as f:
@@ -312,27 +567,42 @@ class CredentialsManager:
         if not isinstance(data, dict):
             raise TypeError('Invalid credentials file configuration')
 
+        # Older files use a different layout and key derivation, there is no
+        # way to read them, so say so rather than report missing fields
+        version = data.get('version')
+        if version != cls.__FILE_VERSION:
+            raise ValueError(
+                'Unsupported or legacy credentials file'
+                f' (version {version!r}, expected {cls.__FILE_VERSION})'
+            )
+
         # These fields are essential, other the data is corrupt
-        if '__cm_password__' not in data or '__salt__' not in data:
+        if any(
+            field not in data
+            for field in ('__cm_password__', '__salt__', 'credentials')
+        ):
             raise ValueError(
                 'Invalid credentials file. Missing required fields'
             )
 
-        # Extract and decode the mappings from the credentials file
-        mappings = {k: bytearray(base64.b64decode(v)) for k, v in data.items()}
+        credentials = data['credentials']
+        if not isinstance(credentials, dict):
+            raise TypeError('Invalid credentials file configuration')
 
-        # Ensure the password hashes match
-        loaded_pwsd = mappings['__cm_password__']
-        if loaded_pwsd != given_pswd:
-            raise ValueError('Incorrect password')
+        # Derive the key for the given password with the stored salt
+        salt = base64.b64decode(data['__salt__'])
+        obj = cls(password=password, salt=salt)
 
-        # Passwords should always be decodable, they were SHA-256 digests
-        # which are represented as ASCII values, so UTF-8 should have no problems
-        password = loaded_pwsd.decode('utf-8')
-        salt = mappings['__salt__']
+        # Ensure the key reproduces the stored verifier, this checks the
+        # password once, before decoding any credentials
+        verifier = base64.b64decode(data['__cm_password__'])
+        if not hmac.compare_digest(obj._password_verifier(), verifier):
+            raise ValueError('Incorrect password')
 
-        # We have all the pieces, create a Credential Manager instance
-        obj = cls(password=password, salt=salt, pswd_is_digest=True)
+        # Extract and decode the mappings from the credentials file
+        # binascii skips the argument coercion b64decode does for every entry
+        decode = binascii.a2b_base64
+        mappings = {k: decode(v) for k, v in credentials.items()}
 
         # Set the mappings
         obj.__mapping = mappings
@@ -1,7 +1,11 @@
+import base64
+import hashlib
+import hmac
 import json
 import os
 import tempfile
 import unittest
+import weakref
 
 try:  # pragma: no cover
     from credentials_manager import CredentialsManager, CredentialsNotFoundError
@@ -17,19 +21,49 @@ except ImportError:  # pragma: no cover
 
 
 class TestCredentialsManager(unittest.TestCase):
+    @staticmethod
+    def _tmp_dir():
+        # Prefer a RAM backed directory for test files, when there is one
+        shm = '/dev/shm'
+        if os.path.isdir(shm) and os.access(shm, os.W_OK):
+            return shm
+        return tempfile.gettempdir()
+
+    password = "test_password"
+
+    @classmethod
+    def setUpClass(cls):
+        # Deriving the key is the expensive part of creating a manager, so
+        # tests share one unless they change its password
+        cls.cm = CredentialsManager(cls.password)
+
     def setUp(self):
-        self.password = "test_password"
-        self.cm = CredentialsManager(self.password)
+        # Credential names unique to each test, the manager is shared
+        self.name = self.id()
 
     def test_store_and_get(self):
-        name = "test_cred"
+        name = self.name
         data = "test_data"
         self.cm.store(name, data)
         retrieved_data = self.cm.get(name)
         self.assertEqual(data, retrieved_data)
 
+    def test_store_and_get_non_ascii(self):
+        name = self.name
+        data = "pässwörd-🔑-" * 20
+        self.cm.store(name, data)
+        retrieved_data = self.cm.get(name)
+        self.assertEqual(data, retrieved_data)
+
+    def test_store_and_get_large(self):
+        name = self.name
+        data = "0123456789abcdef" * 0x200  # Longer than the keystream tile
+        self.cm.store(name, data)
+        retrieved_data = self.cm.get(name)
+        self.assertEqual(data, retrieved_data)
+
     def test_overwrite_protection(self):
-        name = "test_cred"
+        name = self.name
         data1 = "test_data1"
         data2 = "test_data2"
         self.cm.store(name, data1)
@@ -39,6 +73,31 @@ class TestCredentialsManager(unittest.TestCase):
         retrieved_data = self.cm.get(name)
         self.assertEqual(data2, retrieved_data)
 
+    def test_store_many(self):
+        credentials = {f"{self.name}{i}": f"data{i}" for i in range(1, 4)}
+        self.cm.store_many(credentials)
+        for name, data in credentials.items():
+            retrieved_data = self.cm.get(name)
+            self.assertEqual(data, retrieved_data)
+
+    def test_store_many_is_all_or_nothing(self):
+        cred1, cred2, cred3 = (f"{self.name}{i}" for i in range(1, 4))
+        self.cm.store(cred2, "data")
+
+        with self.assertRaises(ValueError):
+            self.cm.store_many({cred1: "data1", cred2: "data2"})
+        with self.assertRaises(ValueError):
+            self.cm.get(cred1)
+
+        with self.assertRaises(TypeError):
+            self.cm.store_many({cred1: "data1", cred3: self})
+        with self.assertRaises(ValueError):
+            self.cm.get(cred1)
+
+        self.cm.store_many({cred1: "data1", cred2: "data2"}, overwrite=True)
+        self.assertEqual("data1", self.cm.get(cred1))
+        self.assertEqual("data2", self.cm.get(cred2))
+
     def test_store_bad_input(self):
         with self.assertRaises(TypeError):
             self.cm.store(self, 'self')
@@ -53,6 +112,57 @@ class TestCredentialsManager(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.cm.get("nonexistent_cred")
 
+    def test_get_tampered(self):
+        name = self.name
+        data = "test_data"
+        cm = CredentialsManager(self.password)  # Own manager, tampered below
+        cm.store(name, data)
+
+        # Cheating a little for testing
+        mapping = cm._CredentialsManager__mapping
+        mapping[name] = bytes([mapping[name][0] ^ 0xFF]) + mapping[name][1:]
+
+        with self.assertRaises(ValueError):
+            cm.get(name)
+
+    def test_weakref(self):
+        ref = weakref.ref(self.cm)
+        self.assertIs(ref(), self.cm)
+
+    def test_get_swapped(self):
+        cm = CredentialsManager(self.password)
+        cm.store("bank", "bank-secret!")
+        cm.store("mail", "mail-secret!")
+
+        # Cheating a little for testing
+        mapping = cm._CredentialsManager__mapping
+        mapping["bank"], mapping["mail"] = mapping["mail"], mapping["bank"]
+
+        with self.assertRaises(ValueError):
+            cm.get("bank")
+        with self.assertRaises(ValueError):
+            cm.get("mail")
+
+    def test_get_forged_with_known_plaintext(self):
+        cm = CredentialsManager(self.password)
+        name = "known"
+        cm.store(name, "k" * 0x40)  # At least as long as the key
+
+        # Knowing the plain text reveals the encryption key, cheating a
+        # little for testing by reading it directly
+        key = cm._CredentialsManager__key_bytes
+
+        forged = bytes(a ^ b for a, b in zip(b"attacker-chosen", key * 2))
+        encoded = name.encode()
+        message = b'\x00' + len(encoded).to_bytes(4, 'big') + encoded + forged
+        for tag in (
+            hmac.digest(key, forged, 'sha256'),
+            hmac.digest(key, message, 'sha256'),
+        ):
+            cm._CredentialsManager__mapping[name] = forged + tag
+            with self.assertRaises(ValueError):
+                cm.get(name)
+
     def test_get_bad_input(self):
         with self.assertRaises(TypeError):
             self.cm.get(self)
@@ -60,6 +170,8 @@ class TestCredentialsManager(unittest.TestCase):
             self.cm.get('')
 
     def test_update_password(self):
+        # Own manager, this test changes the password
+        self.cm = CredentialsManager(self.password)
         name = "test_cred"
         data = "test_data"
         self.cm.store(name, data)
@@ -76,6 +188,8 @@ class TestCredentialsManager(unittest.TestCase):
             self.cm.update_password(self.password, "another_password")
 
     def test_update_password_multiple_times(self):
+        # Own manager, this test changes the password
+        self.cm = CredentialsManager(self.password)
         name = "test_cred"
         data = "test_data"
         self.cm.store(name, data)
@@ -91,11 +205,61 @@ class TestCredentialsManager(unittest.TestCase):
             with self.assertRaises(ValueError):
                 self.cm.update_password(password, "new_password")
 
+    def test_update_password_long_credentials(self):
+        # Own manager, this test changes the password
+        self.cm = CredentialsManager(self.password)
+        # Credentials longer than the key, so the re-keyed keystream wraps
+        credentials = {f"cred{i}": "data" * (i * 0x20) for i in range(1, 4)}
+        for name, data in credentials.items():
+            self.cm.store(name, data)
+
+        new_password = "new_test_password"
+        self.cm.update_password(self.password, new_password)
+
+        for name, data in credentials.items():
+            retrieved_data = self.cm.get(name)
+            self.assertEqual(data, retrieved_data)
+
+    def test_update_password_large_credential(self):
+        # Own manager, this test changes the password
+        self.cm = CredentialsManager(self.password)
+
+        name = self.name
+        data = "0123456789abcdef" * 0x200  # Longer than the keystream tile
+        self.cm.store(name, data)
+
+        self.cm.update_password(self.password, "new_test_password")
+        retrieved_data = self.cm.get(name)
+        self.assertEqual(data, retrieved_data)
+
+    def test_update_password_tampered(self):
+        cm = CredentialsManager(self.password)  # Own manager, tampered below
+        cm.store("good", "good_data")
+        cm.store("bad", "bad_data")
+
+        # Cheating a little for testing
+        mapping = cm._CredentialsManager__mapping
+        blob = mapping["bad"]
+        for tampered in (bytes([blob[0] ^ 0xFF]) + blob[1:], blob[:0x10]):
+            mapping["bad"] = tampered
+            before = dict(mapping), cm._CredentialsManager__salt
+
+            with self.assertRaises(ValueError):
+                cm.update_password(self.password, "new_password")
+
+            # Nothing changed, the old password and credentials still work
+            self.assertEqual(before, (mapping, cm._CredentialsManager__salt))
+            self.assertEqual(cm.get("good"), "good_data")
+            with self.assertRaises(ValueError):
+                cm.get("bad")
+
     def test_update_password_incorrect_old_password(self):
         with self.assertRaises(ValueError):
             self.cm.update_password("wrong_password", "new_password")
 
     def test_update_password_multiple_credentials(self):
+        # Own manager, this test changes the password
+        self.cm = CredentialsManager(self.password)
         credentials = {"cred1": "data1", "cred2": "data2", "cred3": "data3"}
         for name, data in credentials.items():
             self.cm.store(name, data)
@@ -108,11 +272,13 @@ class TestCredentialsManager(unittest.TestCase):
             self.assertEqual(data, retrieved_data)
 
     def test_save_and_load(self):
-        name = "test_cred"
+        name = self.name
         data = "test_data"
         self.cm.store(name, data)
 
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        with tempfile.NamedTemporaryFile(
+            dir=self._tmp_dir(), delete=False
+        ) as tmp:
             filename = tmp.name
             self.cm.save(filename)
 
@@ -122,6 +288,76 @@ class TestCredentialsManager(unittest.TestCase):
 
         os.unlink(filename)
 
+    def test_save_and_load_escaped_names(self):
+        # Own manager, this test needs exact names
+        self.cm = CredentialsManager(self.password)
+
+        credentials = {'say "hi"': "data1", "back\\slash": "data2", "ключ": "3"}
+        for name, data in credentials.items():
+            self.cm.store(name, data)
+
+        with tempfile.NamedTemporaryFile(
+            dir=self._tmp_dir(), delete=False
+        ) as tmp:
+            filename = tmp.name
+            self.cm.save(filename)
+
+        # The file must still be valid JSON
+        with open(filename) as f:
+            self.assertIsInstance(json.load(f), dict)
+
+        loaded_cm = CredentialsManager.load(filename, self.password)
+        for name, data in credentials.items():
+            self.assertEqual(data, loaded_cm.get(name))
+
+        os.unlink(filename)
+
+    def test_save_and_load_reserved_names(self):
+        # Own manager, this test needs exact names
+        self.cm = CredentialsManager(self.password)
+
+        # Credential names must not clash with the file's metadata fields
+        credentials = {"__cm_password__": "data1", "__salt__": "data2"}
+        for name, data in credentials.items():
+            self.cm.store(name, data)
+
+        with tempfile.NamedTemporaryFile(
+            dir=self._tmp_dir(), delete=False
+        ) as tmp:
+            filename = tmp.name
+            self.cm.save(filename)
+
+        loaded_cm = CredentialsManager.load(filename, self.password)
+        for name, data in credentials.items():
+            self.assertEqual(data, loaded_cm.get(name))
+
+        os.unlink(filename)
+
+    def test_save_does_not_store_password_digest(self):
+        with tempfile.NamedTemporaryFile(
+            dir=self._tmp_dir(), delete=False
+        ) as tmp:
+            filename = tmp.name
+            self.cm.save(filename)
+
+        with open(filename) as f:
+            data = json.load(f)
+
+        digest = hashlib.sha256(self.password.encode()).hexdigest()
+        self.assertNotEqual(
+            base64.b64decode(data['__cm_password__']), digest.encode()
+        )
+
+        os.unlink(filename)
+
+    def test_verifier_is_not_a_credential_tag(self):
+        # The verifier covers the same message a credential named '' holding
+        # the password check would, it must still never match that tag
+        self.assertNotEqual(
+            self.cm._password_verifier(),
+            self.cm._tag('', b'__cm_password__'),
+        )
+
     def test_save_bad_filename(self):
         with self.assertRaises(ValueError):
             self.cm.save(self)
@@ -131,7 +367,9 @@ class TestCredentialsManager(unittest.TestCase):
             CredentialsManager.load("nonexistent_file.json", self.password)
 
     def test_load_invalid_file(self):
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmp:
+        with tempfile.NamedTemporaryFile(
+            mode='w', dir=self._tmp_dir(), delete=False
+        ) as tmp:
             tmp.write("invalid json")
             filename = tmp.name
 
@@ -141,7 +379,9 @@ class TestCredentialsManager(unittest.TestCase):
         os.unlink(filename)
 
         data = [{"hello": "world"}]
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmp:
+        with tempfile.NamedTemporaryFile(
+            mode='w', dir=self._tmp_dir(), delete=False
+        ) as tmp:
             json.dump(data, tmp)
             filename = tmp.name
 
@@ -151,11 +391,13 @@ class TestCredentialsManager(unittest.TestCase):
         os.unlink(filename)
 
     def test_load_wrong_password(self):
-        name = "test_cred"
+        name = self.name
         data = "test_data"
         self.cm.store(name, data)
 
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        with tempfile.NamedTemporaryFile(
+            dir=self._tmp_dir(), delete=False
+        ) as tmp:
             filename = tmp.name
             self.cm.save(filename)
 
@@ -172,15 +414,38 @@ class TestCredentialsManager(unittest.TestCase):
         data = [
             {'__cm_password__': 'pswd'},  # Missing __salt__
             {'__salt__': 'pswd'},  # Missing __cm_password__
-            {'hello': 'world'},  # Missing both
+            {'__cm_password__': 'pswd', '__salt__': 'pswd'},  # No credentials
+            {'hello': 'world'},  # Missing all
         ]
 
         for item in data:
-            with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmp:
+            with tempfile.NamedTemporaryFile(
+                mode='w', dir=self._tmp_dir(), delete=False
+            ) as tmp:
+                json.dump({'version': 2, **item}, tmp)
+                filename = tmp.name
+
+            with self.assertRaisesRegex(ValueError, 'Missing required fields'):
+                CredentialsManager.load(filename, self.password)
+
+            os.unlink(filename)
+
+    def test_load_unsupported_version(self):
+        legacy = {  # Layout written by releases up to 0.1.1
+            '__cm_password__': 'cHN3ZA==',
+            '__salt__': 'c2FsdA==',
+            'test_cred': 'ZGF0YQ==',
+        }
+        data = [legacy, {**legacy, 'version': 1}, {**legacy, 'version': 99}]
+
+        for item in data:
+            with tempfile.NamedTemporaryFile(
+                mode='w', dir=self._tmp_dir(), delete=False
+            ) as tmp:
                 json.dump(item, tmp)
                 filename = tmp.name
 
-            with self.assertRaises(ValueError):
+            with self.assertRaisesRegex(ValueError, 'legacy'):
                 CredentialsManager.load(filename, self.password)
 
             os.unlink(filename)